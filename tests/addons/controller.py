@@ -1,15 +1,25 @@
-import random
-from mitmproxy import ctx
-from flask import Flask, request, make_response
+import json
+import logging
+import secrets
+from http.client import responses
+from mitmproxy import ctx, flowfilter
+
+logger = logging.getLogger(__name__)
+
 # must match code in deploy.go
 MITM_DOMAIN_NAME = "mitm.code"
-app = Flask("mitmoptset")
 
 prev_options = {
     "lock_id": "",
     "options": {},
 }
 
+# Compiled flow filters created via POST /create_filter, keyed by an opaque id.
+# Filters are compiled exactly once here so addons can match flows against them
+# repeatedly without re-parsing the filter expression per flow. A value of None
+# means "match all flows".
+filters = {}
+
 # Set options on mitmproxy. See https://docs.mitmproxy.org/stable/concepts-options/
 # This is intended to be used exclusively for our addons in this package, but nothing
 # stops tests from enabling/disabling/tweaking other mitmproxy options.
@@ -25,19 +35,19 @@ prev_options = {
 # }
 # Calling this endpoint locks the proxy from further option modification until /options/unlock
 # is called. This ensures that tests can't forget to reset options when they are done with them.
-@app.route("/options/lock", methods=["POST"])
-def lock_options():
+def lock_options(body):
     if prev_options["lock_id"] != "":
-        return make_response(("options already locked, did you forget to unlock?", 400))
-    body = request.json
+        return 400, "options already locked, did you forget to unlock?"
     options = body.get("options", {})
-    prev_options["lock_id"] = bytes.hex(random.randbytes(8))
-    for k, v in ctx.options.items():
-        if k in options:
-            prev_options["options"][k] = v.current()
-    print(f"locking options {options}")
+    prev_options["lock_id"] = secrets.token_hex(8)
+    # only snapshot the options being overridden rather than walking every
+    # mitmproxy option; unknown keys are left for ctx.options.update to reject.
+    for k in options:
+        if k in ctx.options:
+            prev_options["options"][k] = getattr(ctx.options, k)
+    logger.info("locking options %s", options)
     ctx.options.update(**options)
-    return {
+    return 200, {
         "reset_id": prev_options["lock_id"]
     }
 
@@ -47,20 +57,18 @@ def lock_options():
 # {
 #   "reset_id": "some_opaque_string"
 # }
-@app.route("/options/unlock", methods=["POST"])
-def unlock_options() -> str:
-    body = request.json
+def unlock_options(body):
     reset_id = body.get("reset_id", "")
     if prev_options["lock_id"] == "":
-        return make_response(("options were not locked, mismatched lock/unlock calls", 400))
+        return 400, "options were not locked, mismatched lock/unlock calls"
     if prev_options["lock_id"] != reset_id:
-        return make_response(("refusing to unlock, wrong id supplied", 400))
-    print(f"unlocking options back to {prev_options['options']}")
+        return 400, "refusing to unlock, wrong id supplied"
+    logger.info("unlocking options back to %s", prev_options["options"])
     ctx.options.update(**prev_options["options"])
     # apply AFTER update so if we fail to reset them back we won't unlock, indicating a problem.
     prev_options["lock_id"] = ""
     prev_options["options"] = {}
-    return {}
+    return 200, {}
 
 # Creates a filter which can then be passed to options
 # POST /create_filter
@@ -73,13 +81,54 @@ def unlock_options() -> str:
 # {
 #   "filter_id": "some_opaque_string"
 # }
-@app.route("/create_filter", methods=["POST"])
-def create_filter() -> str:
-    body = request.json
+def create_filter(body):
     filter = body.get("filter", {})
-    print(f"creating filter {filter}")
+    logger.info("creating filter %s", filter)
     hs_filter = filter.get("hs", "")
     user_filter = filter.get("user", "")
     device_filter = filter.get("device", "")
-    ctx.options.update(**options)
-    return {}
\ No newline at end of file
+    # map each field onto a mitmproxy filter expression; "" and "*" both mean
+    # "don't restrict on this field" so they contribute nothing.
+    parts = []
+    if hs_filter and hs_filter != "*":
+        parts.append(f"~d {hs_filter}")
+    if user_filter and user_filter != "*":
+        parts.append(f"~u {user_filter}")
+    if device_filter and device_filter != "*":
+        parts.append(f"~u {device_filter}")
+    compiled = flowfilter.parse(" & ".join(parts)) if parts else None
+    filter_id = secrets.token_hex(8)
+    filters[filter_id] = compiled
+    return 200, {
+        "filter_id": filter_id
+    }
+
+routes = {
+    ("POST", "/options/lock"): lock_options,
+    ("POST", "/options/unlock"): unlock_options,
+    ("POST", "/create_filter"): create_filter,
+}
+
+# A hand-rolled WSGI app: these are two-or-three trivial JSON endpoints hit in
+# lockstep by tests, so Flask's routing/request machinery was pure overhead.
+# mitmproxy's asgiapp.WSGIApp accepts any WSGI callable.
+def app(environ, start_response):
+    handler = routes.get((environ["REQUEST_METHOD"], environ["PATH_INFO"]))
+    if handler is None:
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"not found"]
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = json.loads(environ["wsgi.input"].read(length)) if length else {}
+    except ValueError:
+        start_response("400 Bad Request", [("Content-Type", "text/plain")])
+        return [b"request body must be JSON"]
+    status, payload = handler(body)
+    if isinstance(payload, str): # error message
+        content_type = "text/plain"
+        data = payload.encode()
+    else:
+        content_type = "application/json"
+        data = json.dumps(payload, separators=(",", ":")).encode()
+    start_response(f"{status} {responses[status]}", [("Content-Type", content_type)])
+    return [data]
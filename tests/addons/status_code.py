@@ -1,21 +1,29 @@
+import logging
 from typing import Optional
 
 from mitmproxy import ctx, flowfilter
 from mitmproxy.http import Response
 from controller import MITM_DOMAIN_NAME
 
+logger = logging.getLogger(__name__)
+
 class StatusCode:
+    # no instance __dict__: attribute reads in the per-flow hooks become fixed
+    # slot lookups
+    __slots__ = ("return_status", "filter", "canned_response")
+
     def __init__(self):
         self.reset()
-        print(MITM_DOMAIN_NAME)
-        self.matchall = flowfilter.parse(".")
-        self.filter: Optional[flowfilter.TFilter] = self.matchall
+        logger.info(MITM_DOMAIN_NAME)
 
     def reset(self):
-        self.config = {
-            "return_status": 0,
-            "filter": None,
-        }
+        # plain attributes rather than a config dict: response() runs per flow,
+        # and attribute reads are cheaper than dict lookups there.
+        self.return_status = 0
+        # None means "match everything": skipping flowfilter entirely is cheaper
+        # than evaluating a parsed "." filter on every flow.
+        self.filter: Optional[flowfilter.TFilter] = None
+        self.canned_response: Optional[Response] = None
 
     def load(self, loader):
         loader.add_option(
@@ -32,19 +40,33 @@ class StatusCode:
         if ctx.options.statuscode is None or ctx.options.statuscode["return_status"] == 0:
             self.reset()
             return
-        self.config = ctx.options.statuscode
-        new_filter = self.config.get('filter', None)
-        print(f"statuscode will return HTTP {self.config['return_status']} filter={new_filter}")
-        if new_filter:
-            self.filter = flowfilter.parse(new_filter)
-        else:
-            self.filter = self.matchall
+        config = ctx.options.statuscode
+        new_filter = config.get('filter', None)
+        logger.info("statuscode will return HTTP %s filter=%s", config["return_status"], new_filter)
+        self.return_status = config["return_status"]
+        self.filter = flowfilter.parse(new_filter) if new_filter else None
+        # the replacement response is fixed by configuration, so build it once
+        # here; matching flows get a copy rather than re-running Response.make
+        self.canned_response = Response.make(self.return_status)
+
+    def requestheaders(self, flow):
+        # pretty_host re-parses the Host header on each access, so work it out once
+        # per flow here rather than in response(), which also lets response() bail
+        # before touching it when the addon is disabled (the common case).
+        flow.metadata["statuscode_ignore"] = flow.request.pretty_host == MITM_DOMAIN_NAME
 
     def response(self, flow):
+        if self.return_status == 0:
+            return # ignore responses if we aren't told a code
         # always ignore the controller
-        if flow.request.pretty_host == MITM_DOMAIN_NAME:
+        ignore = flow.metadata.get("statuscode_ignore")
+        if ignore is None: # flow started before this addon was loaded
+            ignore = flow.request.pretty_host == MITM_DOMAIN_NAME
+        if ignore:
             return
-        if self.config["return_status"] == 0:
-            return # ignore responses if we aren't told a code
-        if flowfilter.match(self.filter, flow):
-            flow.response = Response.make(self.config["return_status"])
+        # parsed filters are callable; calling one directly skips the type
+        # dispatch flowfilter.match does on every invocation
+        if self.filter is None or self.filter(flow):
+            # copy so each flow owns its response; sharing one Response object
+            # between concurrent flows isn't safe once mitmproxy mutates it
+            flow.response = self.canned_response.copy()